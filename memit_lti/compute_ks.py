@@ -4,6 +4,8 @@ import numpy as np
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
+from rome_lti import repr_tools
+
 from .compute_z import get_module_input_output_at_words
 from .memit_hparams import MEMITLTIHyperParams
 
@@ -36,6 +38,73 @@ def compute_ks(
         fact_token_strategy=hparams.fact_token,
     )[0]
 
+    return average_over_contexts(layer_ks, context_templates)
+
+
+def compute_ks_and_targets(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    requests: Dict,
+    hparams: MEMITLTIHyperParams,
+    layer: int,
+    z_layer: int,
+    context_templates: List[str],
+):
+    """
+    Computes `compute_ks` for `layer` together with the output of `z_layer` at
+    the subject of each bare prompt, from a single set of forward passes. The
+    bare prompts are the rows produced by the leading "{}" context template.
+    Returns (layer_ks, cur_zs), each with one row per request.
+    """
+
+    if context_templates[0] != ["{}"] or not hparams.fact_token.startswith("subject_"):
+        layer_ks = compute_ks(model, tok, requests, hparams, layer, context_templates)
+        cur_zs = get_module_input_output_at_words(
+            model,
+            tok,
+            z_layer,
+            context_templates=[request["prompt"] for request in requests],
+            words=[request["subject"] for request in requests],
+            module_template=hparams.layer_module_tmp,
+            fact_token_strategy=hparams.fact_token,
+        )[1]
+        return layer_ks, cur_zs
+
+    contexts = [
+        context.format(request["prompt"])
+        for request in requests
+        for context_type in context_templates
+        for context in context_type
+    ]
+    words = [
+        request["subject"]
+        for request in requests
+        for context_type in context_templates
+        for _ in context_type
+    ]
+    idxs = repr_tools.get_words_idxs_in_templates(
+        tok, contexts, words, hparams.fact_token[len("subject_"):]
+    )
+
+    layer_ks, cur_zs = repr_tools.get_reprs_at_idxs(
+        model,
+        tok,
+        [contexts[i].format(words[i]) for i in range(len(words))],
+        idxs,
+        tracks=[
+            (hparams.rewrite_module_tmp.format(layer), "in"),
+            (hparams.layer_module_tmp.format(z_layer), "out"),
+        ],
+    )
+
+    context_len = sum(len(context_type) for context_type in context_templates)
+    layer_ks = layer_ks.detach()
+    cur_zs = cur_zs[::context_len].detach()
+
+    return average_over_contexts(layer_ks, context_templates), cur_zs
+
+
+def average_over_contexts(layer_ks: torch.Tensor, context_templates: List[str]):
     context_type_lens = [0] + [len(context_type) for context_type in context_templates]
     context_len = sum(context_type_lens)
     context_type_csum = np.cumsum(context_type_lens).tolist()
@@ -22,7 +22,36 @@ def compute_z(
 ) -> torch.Tensor:
     """
     Computes the value (right) vector for the rank-1 update.
-    Runs a simple optimization procedure.
+    Runs a simple optimization procedure, see `compute_z_batch`.
+    """
+
+    return compute_z_batch(
+        model,
+        tok,
+        [request],
+        hparams,
+        layer,
+        context_templates,
+        dataset_name=dataset_name,
+    )[0]
+
+
+def compute_z_batch(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    requests: List[Dict],
+    hparams: MEMITLTIHyperParams,
+    layer: int,
+    context_templates: List[str],
+    dataset_name: str = None,
+) -> List[Tuple[torch.Tensor, float, float]]:
+    """
+    Computes the value (right) vectors for a batch of requests by running a
+    simple optimization procedure. The prompts of all requests are run as one
+    padded batch, with a separate delta per request. Requests do not interact
+    and Adam updates every entry independently, so each delta follows the same
+    trajectory as it would alone, including per-request early stopping.
+    Returns one (target, delta norm, init norm) tuple per request.
     """
 
     # Get model parameters
@@ -35,85 +64,99 @@ def compute_z(
     except LookupError as _:
         lm_b = next(model.parameters()).new_zeros(model.config.vocab_size)
 
-    print("Computing right vector (v)")
-
-    # Tokenize target into list of int token IDs
-    target_ids = tok(request["target_new"]["str"], return_tensors="pt").to("cuda")[
-        "input_ids"
-    ][0]
+    print(f"Computing right vectors (v) for {len(requests)} requests")
+
+    kl_prompts = ["{} is a"]
+    all_texts, row_lookup_idxs, row_targets = [], [], []
+    request_rows, request_target_ids = [], []
+    context_kl_log_probs_tar, context_kl_log_probs_mid = [], []
+    for request in requests:
+        # Tokenize target into list of int token IDs
+        target_ids = tok(request["target_new"]["str"], return_tensors="pt").to("cuda")[
+            "input_ids"
+        ][0]
+
+        if target_ids[0] == tok.bos_token_id or target_ids[0] == tok.unk_token_id:
+            target_ids = target_ids[1:]
+        # Compile list of rewriting and KL x/y pairs
+        rewriting_prompts = [
+            context.format(request["prompt"]) + tok.decode(target_ids[:-1])
+            for context_types in context_templates
+            for context in context_types
+        ]
+        all_prompts = rewriting_prompts + kl_prompts
+
+        # Compute indices of the tokens where the fact is looked up
+        lookup_idxs = [
+            find_fact_lookup_idx(
+                prompt, request["subject"], tok, hparams.fact_token, verbose=(
+                    i == 0)
+            )
+            for i, prompt in enumerate(all_prompts)
+        ]
+
+        # Per-request target positions, as if the request were run on its own
+        request_tok = tok(
+            [prompt.format(request["subject"]) for prompt in all_prompts],
+            return_tensors="pt",
+            padding=True,
+        )
+        ex_lens = request_tok["attention_mask"].sum(1).tolist()
+        # Negative lookup indices are relative to this request's own padded length
+        padded_len = request_tok["input_ids"].shape[1]
+        batch_lookup_idxs = [idx + padded_len if idx < 0 else idx for idx in lookup_idxs]
+        target_idxs_start = [ex_len - len(target_ids) for ex_len in ex_lens[:len(rewriting_prompts)]] + [
+            ex_len - 1 for ex_len in ex_lens[len(rewriting_prompts):]
+        ]
+        target_idxs_end = ex_lens
+
+        context_tar, context_mid = get_edit_target(
+            model=model,
+            tok=tok,
+            request=request,
+            hparams=hparams,
+            context_prefix=get_edit_prefix(
+                request=request,
+                hparams=hparams,
+                dataset_name=dataset_name,
+            ),
+            rewriting_prompts=rewriting_prompts,
+            loc_prompts=kl_prompts,
+            target_idxs_start=target_idxs_start,
+            target_idxs_end=target_idxs_end,
+            lookup_idxs=lookup_idxs,
+        )
+        context_kl_log_probs_tar.append(context_tar)
+        context_kl_log_probs_mid.append(context_mid)
 
-    if target_ids[0] == tok.bos_token_id or target_ids[0] == tok.unk_token_id:
-        target_ids = target_ids[1:]
-    # Compile list of rewriting and KL x/y pairs
-    rewriting_prompts, kl_prompts = [
-        context.format(request["prompt"]) + tok.decode(target_ids[:-1])
-        for context_types in context_templates
-        for context in context_types
-    ], ["{} is a"]
-    all_prompts = rewriting_prompts + kl_prompts
+        request_rows.append((len(all_texts), len(rewriting_prompts), len(all_prompts)))
+        request_target_ids.append(target_ids)
+        all_texts += [prompt.format(request["subject"]) for prompt in all_prompts]
+        row_lookup_idxs += batch_lookup_idxs
+        row_targets += list(zip(target_idxs_start, target_idxs_end))
 
     input_tok = tok(
-        [prompt.format(request["subject"]) for prompt in all_prompts],
+        all_texts,
         return_tensors="pt",
         padding=True,
     ).to("cuda")
 
-    target_len = len(target_ids)
-    target_idxs_start = []
-    target_idxs_end = []
-
-    # Compute rewriting targets
+    # Compute rewriting targets; KL rows keep -100 throughout
     rewriting_targets = torch.tensor(-100, device="cuda").repeat(
-        len(rewriting_prompts), *input_tok["input_ids"].shape[1:]
+        *input_tok["input_ids"].shape
     )
-
-    for i in range(len(rewriting_prompts)):
-        ex_len = input_tok["attention_mask"][i].sum()
-        rewriting_targets[i, ex_len - len(target_ids): ex_len] = target_ids
-        target_idxs_start.append(ex_len - len(target_ids))
-        target_idxs_end.append(ex_len)
-
-    for i in range(len(kl_prompts)):
-        ex_len = input_tok["attention_mask"][i+len(rewriting_prompts)].sum()
-        target_idxs_start.append(ex_len - 1)
-        target_idxs_end.append(ex_len)
-
-    # Compute indices of the tokens where the fact is looked up
-    vanilla_input_prompts = [
-        context.format(request["prompt"]).format(request['subject'])
-        for context_types in context_templates
-        for context in context_types
-    ] + [f"{request['subject']} is a"]
-    lookup_idxs = [
-        find_fact_lookup_idx(
-            prompt, request["subject"], tok, hparams.fact_token, verbose=(
-                i == 0)
-        )
-        for i, prompt in enumerate(all_prompts)
-    ]
-
-    # target_idxs = [target_len] * len(rewriting_prompts) + loc_prompt_len
-    # target_idxs_start = [target_len] * \
-    #     len(rewriting_prompts) + lookup_idxs[-len(kl_prompts):]
-    # target_idxs_end = [None]*len(rewriting_prompts) + \
-    #     [None for idx in lookup_idxs[-len(kl_prompts):]]
-
-    context_kl_log_probs_tar, context_kl_log_probs_mid = get_edit_target(
-        model=model,
-        tok=tok,
-        request=request,
-        hparams=hparams,
-        context_prefix=get_edit_prefix(
-            request=request,
-            hparams=hparams,
-            dataset_name=dataset_name,
-        ),
-        rewriting_prompts=rewriting_prompts,
-        loc_prompts=kl_prompts,
-        target_idxs_start=target_idxs_start,
-        target_idxs_end=target_idxs_end,
-        lookup_idxs=lookup_idxs,
+    for (row_start, n_rewrite, _), target_ids in zip(request_rows, request_target_ids):
+        for i in range(row_start, row_start + n_rewrite):
+            idxst, idxed = row_targets[i]
+            rewriting_targets[i, idxst:idxed] = target_ids
+
+    # Request index owning each row, used to add the right delta to each prompt
+    row_request = torch.tensor(
+        [r for r, (_, _, n_rows) in enumerate(request_rows) for _ in range(n_rows)],
+        device="cuda",
     )
+    row_ids = torch.arange(len(all_texts), device="cuda")
+    lookup_ids = torch.tensor(row_lookup_idxs, device="cuda")
 
     trace_layers_mid = [
         hparams.layer_module_tmp.format(layer) for layer in hparams.midlayers
@@ -127,76 +170,73 @@ def compute_z(
     print(f"Rewrite layer is {layer}")
     print(f"Tying optimization objective to {loss_layer}")
 
-    # Set up an optimization over a latent vector that, when output at the
-    # rewrite layer, i.e. hypothesized fact lookup location, will induce the
-    # target token to be predicted at the final layer.
+    # Set up an optimization over one latent vector per request that, when
+    # output at the rewrite layer, i.e. hypothesized fact lookup location,
+    # will induce the target token to be predicted at the final layer.
     if hasattr(model.config, 'n_embd'):
-        delta = torch.zeros((model.config.n_embd,),
+        delta = torch.zeros((len(requests), model.config.n_embd),
                             requires_grad=True, device="cuda")
     else:
-        delta = torch.zeros((model.config.hidden_size,),
+        delta = torch.zeros((len(requests), model.config.hidden_size),
                             requires_grad=True, device="cuda")
 
-    target_init, kl_distr_init = None, None
-    midlayer_vec, subject_vec, last_vec = None, None, None
+    target_init = None
+    subject_vec, last_vec = None, None
 
-    # Inserts new "delta" variable at the appropriate part of the computation
+    # Inserts new "delta" variables at the appropriate part of the computation
     def edit_output_fn(cur_out, cur_layer):
-        nonlocal target_init, midlayer_vec, subject_vec, last_vec
+        nonlocal target_init, subject_vec, last_vec
 
         if cur_layer in trace_layers_mid:
-            tmp_repr = cur_out[0]
-            subject_vec = torch.stack(
-                [
-                    tmp_repr[i, idx, :]
-                    for i, idx in enumerate(lookup_idxs)
-                ],
-                dim=0
-            ).unsqueeze(1)
+            subject_vec = cur_out[0][row_ids, lookup_ids, :].unsqueeze(1)
 
         if cur_layer in trace_layers_final:
             tmp_repr = cur_out[0]
-            last_vec = torch.cat(
-                [
-                    tmp_repr[i, idxst:idxed, :]
-                    for i, (idxst, idxed) in enumerate(zip(target_idxs_start, target_idxs_end))
-                ],
-                dim=0
-            ).unsqueeze(1)
-
-            # 根据 hparams.constr_pos 决定返回哪个向量或组合
-        if hparams.constr_pos == "subject":
-            midlayer_vec = subject_vec
-        elif hparams.constr_pos == "last":
-            midlayer_vec = last_vec
-        elif hparams.constr_pos == "all":
-            if last_vec is not None:
-                midlayer_vec = torch.cat([subject_vec, last_vec], dim=0)
-        else:
-            raise ValueError(
-                f"Unsupported constr_pos: {hparams.constr_pos}")
+            last_vec = [
+                tmp_repr[i, idxst:idxed, :]
+                for i, (idxst, idxed) in enumerate(row_targets)
+            ]
 
         if cur_layer == hparams.layer_module_tmp.format(layer):
-            # Store initial value of the vector of interest
+            # Store initial value of the vectors of interest
             if target_init is None:
                 print("Recording initial value of v*")
-                # Initial value is recorded for the clean sentence
-                target_init = cur_out[0][0, lookup_idxs[0]].detach().clone()
+                # Initial value is recorded for the clean sentence of each request
+                target_init = torch.stack(
+                    [cur_out[0][row_start, row_lookup_idxs[row_start]] for row_start, _, _ in request_rows],
+                    dim=0,
+                ).detach().clone()
 
             # Add intervened delta
-            for i, idx in enumerate(lookup_idxs):
-
-                if len(lookup_idxs) != len(cur_out[0]):
-                    cur_out[0][idx, i, :] += delta
-                else:
-                    cur_out[0][i, idx, :] += delta
+            if len(row_lookup_idxs) != len(cur_out[0]):
+                cur_out[0][lookup_ids, row_ids, :] += delta[row_request]
+            else:
+                cur_out[0][row_ids, lookup_ids, :] += delta[row_request]
 
         return cur_out
 
+    def midlayer_vec_of(r):
+        row_start, _, n_rows = request_rows[r]
+        rows = range(row_start, row_start + n_rows)
+        request_subject_vec = subject_vec[row_start: row_start + n_rows]
+        request_last_vec = torch.cat([last_vec[i] for i in rows], dim=0).unsqueeze(1)
+        if hparams.constr_pos == "subject":
+            return request_subject_vec
+        elif hparams.constr_pos == "last":
+            return request_last_vec
+        elif hparams.constr_pos == "all":
+            return torch.cat([request_subject_vec, request_last_vec], dim=0)
+        else:
+            raise ValueError(
+                f"Unsupported constr_pos: {hparams.constr_pos}")
+
     # Optimizer
     opt = torch.optim.Adam([delta], lr=hparams.v_lr)
     nethook.set_requires_grad(False, model)
 
+    results = [None] * len(requests)
+    device = torch.device("cuda:0")
+
     # Execute optimization
     for it in range(hparams.v_num_grad_steps):
         opt.zero_grad()
@@ -214,23 +254,6 @@ def compute_z(
         ) as tr:
             logits = model(**input_tok).logits
 
-            kl_logits = torch.cat(
-                [
-                    logits[i, idxst:idxed, :]
-                    for i, (idxst, idxed) in enumerate(zip(target_idxs_start, target_idxs_end))
-                ],
-                dim=0,
-            )
-
-        # print(f"MIDLAYER_VEC_SHAPE:{midlayer_vec.shape}")
-        midlayer_logits = ln_f(
-            midlayer_vec) @ lm_w.to(midlayer_vec.device) + lm_b.to(midlayer_vec.device)
-
-        # kl_logits=torch.cat([midlayer_logits.squeeze(1),kl_logits],dim=0)
-        kl_log_probs = torch.nn.functional.log_softmax(kl_logits, dim=1)
-        mid_log_probs = torch.nn.functional.log_softmax(
-            midlayer_logits.squeeze(1), dim=1)
-
         # Compute loss on rewriting targets
         log_probs = torch.log_softmax(logits, dim=2)
 
@@ -242,56 +265,77 @@ def compute_z(
         ).squeeze(2)
         mask = (rewriting_targets != -100).float()
 
-        # Aggregate total losses
-        nll_loss_each = -(loss * mask).sum(1) / target_ids.size(0)
-        nll_loss = nll_loss_each.mean()*hparams.nll_factor
-        # nll_loss = nll_loss_each.mean()
+        total_loss = 0
+        for r, request in enumerate(requests):
+            if results[r] is not None:
+                continue
+            row_start, n_rewrite, n_rows = request_rows[r]
 
-        kl_loss = hparams.last_kl_factor * torch.nn.functional.kl_div(
-            context_kl_log_probs_tar, kl_log_probs, log_target=True, reduction="batchmean"
-        )
+            kl_logits = torch.cat(
+                [
+                    logits[i, idxst:idxed, :]
+                    for i, (idxst, idxed) in enumerate(row_targets[row_start: row_start + n_rows], row_start)
+                ],
+                dim=0,
+            )
+            midlayer_vec = midlayer_vec_of(r)
+            midlayer_logits = ln_f(
+                midlayer_vec) @ lm_w.to(midlayer_vec.device) + lm_b.to(midlayer_vec.device)
 
-        mid_kl_loss = hparams.mid_kl_factor * torch.nn.functional.kl_div(
-            context_kl_log_probs_mid, mid_log_probs, log_target=True, reduction="batchmean"
-        )
+            kl_log_probs = torch.nn.functional.log_softmax(kl_logits, dim=1)
+            mid_log_probs = torch.nn.functional.log_softmax(
+                midlayer_logits.squeeze(1), dim=1)
 
-        weight_decay = hparams.v_weight_decay * (
-            torch.norm(delta) / torch.norm(target_init) ** 2
-        )
+            # Aggregate total losses
+            rewrite_rows = slice(row_start, row_start + n_rewrite)
+            nll_loss_each = -(loss[rewrite_rows] * mask[rewrite_rows]).sum(1) / request_target_ids[r].size(0)
+            nll_loss = nll_loss_each.mean()*hparams.nll_factor
 
-        device = torch.device("cuda:0")
-        # weight_decay = hparams.v_weight_decay * torch.norm(delta) ** 2
-        loss = kl_loss.to(device) + mid_kl_loss.to(device) + \
-            weight_decay.to(device) + nll_loss.to(device)
+            kl_loss = hparams.last_kl_factor * torch.nn.functional.kl_div(
+                context_kl_log_probs_tar[r], kl_log_probs, log_target=True, reduction="batchmean"
+            )
 
-        print(
-            f"loss {np.round(loss.item(), 3)} = {np.round(nll_loss.item(), 3)} + {np.round(kl_loss.item(), 3)} + {np.round(mid_kl_loss.item(), 3)} + {np.round(weight_decay.item(), 3)} "
-            f"avg prob of [{request['target_new']['str']}] "
-            f"{torch.exp(-nll_loss_each).mean().item()}"
-        )
+            mid_kl_loss = hparams.mid_kl_factor * torch.nn.functional.kl_div(
+                context_kl_log_probs_mid[r], mid_log_probs, log_target=True, reduction="batchmean"
+            )
 
-        if loss < 5e-2:
-            break
+            weight_decay = hparams.v_weight_decay * (
+                torch.norm(delta[r]) / torch.norm(target_init[r]) ** 2
+            )
+
+            request_loss = kl_loss.to(device) + mid_kl_loss.to(device) + \
+                weight_decay.to(device) + nll_loss.to(device)
 
-        if it == hparams.v_num_grad_steps - 1:
+            print(
+                f"[{r}] loss {np.round(request_loss.item(), 3)} = {np.round(nll_loss.item(), 3)} + {np.round(kl_loss.item(), 3)} + {np.round(mid_kl_loss.item(), 3)} + {np.round(weight_decay.item(), 3)} "
+                f"avg prob of [{request['target_new']['str']}] "
+                f"{torch.exp(-nll_loss_each).mean().item()}"
+            )
+
+            if request_loss < 5e-2 or it == hparams.v_num_grad_steps - 1:
+                target = (target_init[r] + delta[r]).detach().clone()
+                print(
+                    f"[{r}] Init norm {target_init[r].norm()} | Delta norm {delta[r].norm()} | Target norm {target.norm()}"
+                )
+                results[r] = (target, delta[r].norm().item(), target_init[r].norm().item())
+            else:
+                total_loss = total_loss + request_loss
+
+        if all(result is not None for result in results):
             break
 
         # Backpropagate
-        loss.backward()
+        total_loss.backward()
         opt.step()
 
         # Project within L2 ball
-        max_norm = hparams.clamp_norm_factor * target_init.norm()
-        if delta.norm() > max_norm:
-            with torch.no_grad():
-                delta[...] = delta * max_norm / delta.norm()
-
-    target = target_init + delta
-    print(
-        f"Init norm {target_init.norm()} | Delta norm {delta.norm()} | Target norm {target.norm()}"
-    )
+        with torch.no_grad():
+            max_norms = hparams.clamp_norm_factor * target_init.norm(dim=1)
+            delta_norms = delta.norm(dim=1)
+            scale = torch.where(delta_norms > max_norms, max_norms / delta_norms, torch.ones_like(delta_norms))
+            delta[...] = delta * scale.unsqueeze(1)
 
-    return target, delta.norm().item(), target_init.norm().item()
+    return results
 
 
 def get_module_input_output_at_words(
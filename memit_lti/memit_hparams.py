@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List, Literal
+from typing import List, Literal, Optional
 
 from util.hparams import HyperParams
 
@@ -48,6 +48,15 @@ class MEMITLTIHyperParams(HyperParams):
     sentence_model_name: str = None
     top_k: int = 4
 
+    sequential: bool = False
     add_prev_edits: bool = True
     calculate_objective_value: bool = False
     calculate_norms: bool = False
+    svd_rank: Optional[int] = None
+    cov_cache_dtype: str = "float32"
+    cache_cov_factor: bool = False
+    solve_precision: Literal["fp64", "fp32", "mixed"] = "fp64"
+    seq_cache_device: str = "cuda"
+    z_batch_size: int = 1
+    quantize_preserved_keys: bool = False
+    compile_layer_update: bool = False
@@ -1,4 +1,7 @@
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
@@ -12,15 +15,19 @@ from rome_lti.layer_stats import layer_stats
 from util import nethook
 from util.generate import generate_fast
 from util.globals import *
+from util.local_cache import local_path, resolve_local, temp_path, write_through
 
-from .compute_ks import compute_ks
-from .compute_z import compute_z, get_module_input_output_at_words, find_fact_lookup_idx
+from .compute_ks import compute_ks_and_targets
+from .compute_z import compute_z_batch, find_fact_lookup_idx
 from .memit_hparams import MEMITLTIHyperParams
 
 # Cache variable(s)
 CONTEXT_TEMPLATES_CACHE = None
 COV_CACHE = {}
 SEQ_CACHE = {} 
+CHOL_CACHE = {}
+COV_STREAM = None
+COMPILED_FNS = {}
 
 
 def apply_memit_lti_rect_to_model(
@@ -63,21 +70,19 @@ def apply_memit_lti_rect_to_model(
             k_percent = 40
             epsilon = 1e-8
             delta = torch.abs(upd_matrix / (w + epsilon))
+            # kthvalue rather than topk: k is 40% of the elements, not k << n, so a
+            # partial top-k selection does no less work and needs an extra index buffer
             threshold = torch.kthvalue(delta.reshape(-1), int(delta.numel() * (100 - k_percent) / 100)).values
-            with torch.no_grad():
-                mask = delta >= threshold
-                w[mask] += upd_matrix[mask].float()
+            del delta
+            maybe_compile(masked_add_, hparams.compile_layer_update)(w, upd_matrix, threshold, epsilon)
+            del upd_matrix
 
             # w[...] += upd_matrix.float()
 
             if hparams.calculate_norms:
-                start = time.time()
-                _, svd_upd, _ = torch.linalg.svd(upd_matrix)
-                svd_upd = sorted(svd_upd.detach().cpu().tolist(), reverse=True)
-                
-                _, svd_final, _ = torch.linalg.svd(w[...])
-                svd_final = sorted(svd_final.detach().cpu().tolist(), reverse=True)
-                print('svd calculation time:', time.time() - start)
+                # Kept on the GPU; all layers are fetched together after the loop
+                svd_upd = low_rank_singular_values(key_mat, val_mat)[:hparams.svd_rank or None]
+                svd_final = top_singular_values(w[...], hparams.svd_rank)
             else:
                 svd_final = None
                 svd_upd = None
@@ -88,7 +93,7 @@ def apply_memit_lti_rect_to_model(
                 'preservation_distance': preservation_distance,
                 'new_edit_distance': new_edit_distance,
                 'old_edit_distance': old_edit_distance,
-                'delta_norm': torch.norm(upd_matrix).detach().cpu().item(),
+                'delta_norm': low_rank_norm(key_mat, val_mat).detach().cpu().item(),
                 'new_weights_norm': torch.norm(w[...]).detach().cpu().item(),
                 'original_weights_norm': original_weights_norm,
                 'inside_norms': inside_norms,
@@ -98,6 +103,18 @@ def apply_memit_lti_rect_to_model(
             }
             distances[layer] = temp_dict
 
+        if hparams.calculate_norms and deltas:
+            # Fetch every layer's singular values from the GPU in a single transfer
+            svd_entries = [
+                (distances[w_name.split('.')[2]], name)
+                for w_name in deltas
+                for name in ['svd_upd', 'svd_final']
+            ]
+            svd_vals = torch.cat([layer_dists[name].double() for layer_dists, name in svd_entries]).cpu().tolist()
+            for layer_dists, name in svd_entries:
+                n_vals = layer_dists[name].numel()
+                layer_dists[name], svd_vals = svd_vals[:n_vals], svd_vals[n_vals:]
+
     print(f"New weights successfully inserted into {list(deltas.keys())}")
 
     return model, weights_copy, distances, time_compute_z, total_inserting_time
@@ -138,62 +155,86 @@ def execute_memit_lti(
         )
         for layer in hparams.layers
     }
-    # Save old weights for future restoration
-    weights_copy = {k: v.detach().clone() for k, v in weights.items()}
+    # Save old weights for future restoration, in pinned host memory rather than on the GPU
+    weights_copy = {
+        k: torch.empty_like(v, device="cpu", pin_memory=True).copy_(v.detach())
+        for k, v in weights.items()
+    }
 
     # Compute z for final layer
     start_compute_z = time.time()
     context_templates = get_context_templates(model, tok)
     z_layer = hparams.layers[-1]
-    z_list = []
-
-    for r_id, request in enumerate(requests):
-        print(r_id)
-        # Retrieve k/v pair if already stored in cache
-        cache_fname = (
-            Path(
-                str(cache_template).format(
-                    z_layer, hparams.clamp_norm_factor, request["case_id"]
-                )
+    z_list = [None] * len(requests)
+
+    cache_fnames = [
+        Path(
+            str(cache_template).format(
+                z_layer, hparams.clamp_norm_factor, request["case_id"]
             )
-            if cache_template is not None
-            else None
         )
-        data_loaded = False
-        if (
-            cache_fname is not None  # Require cache template
-            and cache_fname.exists()  # Cache file must exist
-        ):
-            try:
-                data = np.load(cache_fname)
-                z_list.append(torch.from_numpy(data["v_star"]).to("cuda"))
-                data_loaded = True
-            except Exception as e:
-                print(f"Error reading cache file due to {e}. Recomputing...")
-
-        # Compute k/v pair if not loaded from cache
-        if not data_loaded:
-            cur_z, delta_norm, init_norm = compute_z(
+        if cache_template is not None
+        else None
+        for request in requests
+    ]
+
+    # Cache reads are prefetched and writes are deferred to a small thread
+    # pool, so disk I/O overlaps with compute_z instead of serializing with it
+    with ThreadPoolExecutor(max_workers=4) as io_pool:
+        pending_loads = {
+            r_id: io_pool.submit(load_cached_z, cache_fname)
+            for r_id, cache_fname in enumerate(cache_fnames)
+            if cache_fname is not None
+        }
+        pending_saves = []
+
+        def compute_missing_zs(r_ids):
+            # Compute k/v pairs not loaded from cache, batched `z_batch_size` at a time
+            results = compute_z_batch(
                 model,
                 tok,
-                request,
+                [requests[r_id] for r_id in r_ids],
                 hparams,
                 z_layer,
                 context_templates,
             )
 
-            z_norms[r_id] = {'delta': delta_norm, 'init_norm': init_norm, 'final_norm': cur_z.norm().item()}
-            z_list.append(cur_z)
-
-            if cache_fname is not None:
-                cache_fname.parent.mkdir(exist_ok=True, parents=True)
-                np.savez(
-                    cache_fname,
-                    **{
-                        "v_star": cur_z.detach().cpu().numpy(),
-                    },
-                )
-                print(f"Cached k/v pair at {cache_fname}")
+            for r_id, (cur_z, delta_norm, init_norm) in zip(r_ids, results):
+                z_norms[r_id] = {'delta': delta_norm, 'init_norm': init_norm, 'final_norm': cur_z.norm().item()}
+                z_list[r_id] = cur_z
+
+                cache_fname = cache_fnames[r_id]
+                if cache_fname is not None:
+                    cache_fname.parent.mkdir(exist_ok=True, parents=True)
+                    pending_saves.append(
+                        io_pool.submit(save_cached_z, cache_fname, cur_z.detach().cpu().numpy())
+                    )
+                    print(f"Caching k/v pair at {z_cache_npy_path(cache_fname)}")
+
+        missing = []
+        for r_id, request in enumerate(requests):
+            print(r_id)
+            cache_fname = cache_fnames[r_id]
+
+            # Retrieve k/v pair if already stored in cache
+            data_loaded = False
+            if cache_fname is not None:  # Require cache template
+                try:
+                    v_star = pending_loads.pop(r_id).result()
+                    if v_star is not None:  # Cache file must exist
+                        z_list[r_id] = torch.from_numpy(v_star).pin_memory().to("cuda", non_blocking=True)
+                        data_loaded = True
+                except Exception as e:
+                    print(f"Error reading cache file due to {e}. Recomputing...")
+
+            if not data_loaded:
+                missing.append(r_id)
+            if len(missing) == hparams.z_batch_size or (missing and r_id == len(requests) - 1):
+                compute_missing_zs(missing)
+                missing = []
+
+        for future in pending_saves:
+            future.result()
     zs = torch.stack(z_list, dim=1)
     time_compute_z = time.time() - start_compute_z
 
@@ -203,29 +244,8 @@ def execute_memit_lti(
         start_inserting_time = time.time()
         print(f"\n\nLAYER {layer}\n")
 
-        # Get current model activations
-        layer_ks = compute_ks(model, tok, requests,
-                              hparams, layer, context_templates).T
-        print(
-            f"Writing {layer_ks.size(1)} key/value pair(s) into layer {layer}")
-
-        # Compute residual error
-        cur_zs = get_module_input_output_at_words(
-            model,
-            tok,
-            z_layer,
-            context_templates=[request["prompt"] for request in requests],
-            words=[request["subject"] for request in requests],
-            module_template=hparams.layer_module_tmp,
-            fact_token_strategy=hparams.fact_token
-        )[1].T
-        targets = zs - cur_zs
-        print("z error", torch.linalg.norm(targets, dim=0).mean())
-
-        repeat_factor = (layer_ks.size(1) // targets.size(1))
-        targets = targets.repeat_interleave(repeat_factor, dim=1)
-
-        # Load covariance matrix
+        # Load covariance matrix. The host-to-device copy runs on a side
+        # stream, so it overlaps with the forward passes below
         force_recompute = False
         # force_recompute = layer != hparams.layers[0]
         cov, preserved_keys = get_cov(
@@ -238,9 +258,28 @@ def execute_memit_lti(
             else hparams.mom2_n_samples // 10,
             hparams.mom2_dtype,
             force_recompute=force_recompute,
+            cache_dtype=hparams.cov_cache_dtype,
+            quantize_preserved_keys=hparams.quantize_preserved_keys,
         )
 
-       
+        # Get current model activations, along with the z_layer outputs in the same forward passes
+        layer_ks, cur_zs = compute_ks_and_targets(model, tok, requests,
+                              hparams, layer, z_layer, context_templates)
+        layer_ks, cur_zs = layer_ks.T, cur_zs.T
+        print(
+            f"Writing {layer_ks.size(1)} key/value pair(s) into layer {layer}")
+
+        # Compute residual error
+        targets = zs - cur_zs
+        print("z error", torch.linalg.norm(targets, dim=0).mean())
+
+        repeat_factor = (layer_ks.size(1) // targets.size(1))
+        targets = targets.repeat_interleave(repeat_factor, dim=1)
+
+        # Wait for the covariance transfer before its first use
+        torch.cuda.current_stream().wait_stream(get_cov_stream())
+        cov.record_stream(torch.cuda.current_stream())
+
         # Compute update in double precision
         layer_ks, targets, cov = (
             layer_ks.double(),
@@ -260,42 +299,75 @@ def execute_memit_lti(
 
         #calculate effective covariance matrix
         if layer in SEQ_CACHE and hparams.sequential and hparams.add_prev_edits:
-            cov += SEQ_CACHE[layer].to(cov.device)
-
-        ##Store previous sequential
-        if layer not in SEQ_CACHE:
-            SEQ_CACHE[layer] = (layer_ks @ layer_ks.T).cpu()
-        else:
-            SEQ_CACHE[layer] += (layer_ks @ layer_ks.T).cpu()
+            cov += SEQ_CACHE[layer].to(cov.device, non_blocking=True)
+
+        ##Store previous sequential, kept in fp32 on seq_cache_device to avoid a PCIe round trip per batch
+        if hparams.sequential and hparams.add_prev_edits:
+            if layer not in SEQ_CACHE:
+                SEQ_CACHE[layer] = torch.zeros(
+                    cov.shape,
+                    dtype=torch.float32,
+                    device=hparams.seq_cache_device,
+                    pin_memory=hparams.seq_cache_device == "cpu",
+                )
+            layer_ks_f32 = layer_ks.float()
+            SEQ_CACHE[layer].add_((layer_ks_f32 @ layer_ks_f32.T).to(SEQ_CACHE[layer].device))
 
 
         ###NOTE - The past memory term is scaled by hparams.mom2_update_weight or sqrt of it. 
-        adj_k = torch.linalg.solve(
-            cov + layer_ks @ layer_ks.T,
-            layer_ks,
-        ).cuda()
+        if hparams.cache_cov_factor:
+            adj_k = cached_factor_solve(
+                cov_cache_key(model, hparams.rewrite_module_tmp.format(layer)),
+                cov,
+                layer_ks,
+                cov_tag=(hparams.mom2_update_weight, hparams.cov_cache_dtype),
+                track_edits=hparams.sequential and hparams.add_prev_edits,
+                precision=hparams.solve_precision,
+            ).cuda()
+        else:
+            adj_k = spd_solve(
+                cov + layer_ks @ layer_ks.T,
+                layer_ks,
+                precision=hparams.solve_precision,
+            ).cuda()
 
         ###Layer distribution code
-        resid = targets / (len(hparams.layers) - i)  # Distribute residual across layers
-        upd_matrix = resid @ adj_k.T
+        resid, upd_matrix = maybe_compile(layer_update, hparams.compile_layer_update)(
+            adj_k, targets, targets.new_tensor(len(hparams.layers) - i)
+        )
         editing_times.append(time.time() - start_inserting_time)
 
 
 
         ##calculate_norms
-        inside_norms = {
-                'zs_norm' : torch.mean(torch.norm(zs, dim = 0)).detach().cpu().item(),
-                'cur_zs_norm' : torch.mean(torch.norm(cur_zs, dim = 0)).detach().cpu().item(),
-                'layer_ks_norm' : torch.mean(torch.norm(layer_ks, dim = 0)).detach().cpu().item(),
-                'adj_norm' : torch.mean(torch.norm(adj_k , dim = 0)).detach().cpu().item(),
-                'residual_norm' : torch.mean(torch.norm(resid , dim = 0)).detach().cpu().item(),
-                'inside_update_norm' : torch.norm(upd_matrix).detach().cpu().item(),
-                'pseudo_inverse' : pseudo_inverse,
-                'C_inv_norm' : C_inv_norm,
-                'D_inv_norm' : D_inv_norm,
-                'D_norm' : D_norm,
-                'cov' : torch.norm(cov).detach().cpu().item(),
-        }
+        if hparams.calculate_norms:
+            # Norms are stacked on the GPU so they are fetched with a single sync
+            norm_vals = torch.stack([
+                x.double() for x in [
+                    torch.linalg.norm(zs, dim=0).mean(),
+                    torch.linalg.norm(cur_zs, dim=0).mean(),
+                    torch.linalg.norm(layer_ks, dim=0).mean(),
+                    torch.linalg.norm(adj_k, dim=0).mean(),
+                    torch.linalg.norm(resid, dim=0).mean(),
+                    torch.linalg.norm(upd_matrix),
+                    torch.linalg.norm(cov),
+                ]
+            ]).cpu().tolist()
+            inside_norms = {
+                    'zs_norm' : norm_vals[0],
+                    'cur_zs_norm' : norm_vals[1],
+                    'layer_ks_norm' : norm_vals[2],
+                    'adj_norm' : norm_vals[3],
+                    'residual_norm' : norm_vals[4],
+                    'inside_update_norm' : norm_vals[5],
+                    'pseudo_inverse' : pseudo_inverse,
+                    'C_inv_norm' : C_inv_norm,
+                    'D_inv_norm' : D_inv_norm,
+                    'D_norm' : D_norm,
+                    'cov' : norm_vals[6],
+            }
+        else:
+            inside_norms = None
         
         # Adjust update matrix shape
         weight_name = f"{hparams.rewrite_module_tmp.format(layer)}.weight"
@@ -306,13 +378,14 @@ def execute_memit_lti(
 
         # Update model weights and record desired changes in `delta` variable
         with torch.no_grad():
-            weights[weight_name][...] = weights_copy[weight_name] + upd_matrix.float()
-
-            #calculate distances
+            #calculate distances, before the update while the weights still hold their original values
             if hparams.calculate_objective_value:
-                preservation_distance, new_edit_distance, old_edit_distance = calculate_distances(weights_copy[weight_name], weights[weight_name][...], layer_ks, zs, preserved_keys)
+                preservation_distance, new_edit_distance, old_edit_distance = calculate_distances(weights[weight_name], adj_k, resid, layer_ks, zs, preserved_keys)
             else:
                 preservation_distance, new_edit_distance, old_edit_distance = None, None, None
+
+            # Each layer is edited once per call, so its weights still equal `weights_copy` here
+            weights[weight_name].add_(upd_matrix.float())
             
             deltas[weight_name] = (
                 adj_k.detach().cpu(),
@@ -323,18 +396,16 @@ def execute_memit_lti(
                 inside_norms
             )
 
-        # Clear GPU memory
-        cov = cov.cpu()
-        for x in [layer_ks, cur_zs, targets]:
-            x = x.cpu()
-            del x
-        torch.cuda.empty_cache()
+        # Drop per-layer GPU tensors; the caching allocator reuses their blocks for the next layer
+        del cov, layer_ks, cur_zs, targets, adj_k, resid, upd_matrix
 
+    # Clear GPU memory
+    torch.cuda.empty_cache()
 
     # Restore state of original model
     with torch.no_grad():
         for k, v in weights.items():
-            v[...] = weights_copy[k]
+            v.copy_(weights_copy[k], non_blocking=True)
 
     print(f"Deltas successfully computed for {list(weights.keys())}")
     total_editing_time = sum(editing_times)
@@ -342,6 +413,68 @@ def execute_memit_lti(
     return deltas, z_norms,time_compute_z, total_editing_time
 
        
+def quantize_rows(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric per-row int8 quantization. Returns (int8 values, float32 scales of shape [N, 1]),
+    both on the device of `x`.
+    """
+
+    scales = (x.float().abs().amax(dim=1, keepdim=True) / 127).clamp_min(1e-12)
+    q = (x.float() / scales).round().to(torch.int8)
+    return q, scales
+
+
+def z_cache_npy_path(cache_fname: Path) -> Path:
+    """
+    Maps a (legacy .npz) cache filename onto its raw .npy counterpart.
+    """
+
+    name = cache_fname.name
+    if name.endswith(".npz"):
+        name = name[: -len(".npz")]
+    return cache_fname.with_name(name + ".npy")
+
+
+def load_cached_z(cache_fname: Path) -> Optional[np.ndarray]:
+    """
+    Loads a cached v* vector, preferring the memory-mapped .npy layout and
+    falling back to legacy .npz archives. Returns None on a cache miss.
+    """
+
+    npy_fname = resolve_local(z_cache_npy_path(cache_fname))
+    if npy_fname.exists():
+        return np.array(np.load(npy_fname, mmap_mode="r"))
+    cache_fname = resolve_local(cache_fname)
+    if cache_fname.exists():
+        return np.load(cache_fname)["v_star"]
+    return None
+
+
+def save_cached_z(cache_fname: Path, v_star: np.ndarray):
+    npy_fname = z_cache_npy_path(cache_fname)
+    local_fname = local_path(npy_fname)
+    if local_fname is None:
+        save_npy_atomic(npy_fname, v_star)
+        return
+
+    # Write into the local mirror first, then upload to the shared location
+    local_fname.parent.mkdir(exist_ok=True, parents=True)
+    save_npy_atomic(local_fname, v_star)
+    write_through(local_fname, npy_fname)
+
+
+def save_npy_atomic(fname: Path, arr: np.ndarray):
+    """
+    Saves `arr` to `fname` through a temporary file, so concurrent readers
+    never see a partially written .npy.
+    """
+
+    tmp_fname = temp_path(fname)
+    with open(tmp_fname, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_fname, fname)
+
+
 def get_cov(
     model: AutoModelForCausalLM,
     tok: AutoTokenizer,
@@ -351,15 +484,19 @@ def get_cov(
     mom2_dtype: str,
     inv: bool = False,
     force_recompute: bool = False,
+    cache_dtype: str = "float32",
+    quantize_preserved_keys: bool = False,
 ) -> torch.Tensor:
     """
     Retrieves covariance statistics, then computes the algebraic inverse.
-    Caches result for future use.
+    Caches result for future use, stored as `cache_dtype` to reduce the
+    host memory and transfer size of the cached covariance. The preserved
+    keys can likewise be cached as int8 with per-row scales.
     """
 
-    model_name = model.config._name_or_path.replace("/", "_")
-    key = (model_name, layer_name)
-    feature_key = (model_name, layer_name, "preserved_keys")
+    key = cov_cache_key(model, layer_name)
+    feature_key = key + ("preserved_keys",)
+    model_name = key[0]
 
     print(f"Retrieving covariance statistics for {model_name} @ {layer_name}.")
     if key not in COV_CACHE or force_recompute:
@@ -374,32 +511,214 @@ def get_cov(
             precision=mom2_dtype,
             force_recompute=force_recompute,
         )
-        COV_CACHE[key] = stat.mom2.moment().float().to("cpu")
+        COV_CACHE[key] = stat.mom2.moment().to(getattr(torch, cache_dtype)).cpu().pin_memory()
+        CHOL_CACHE.pop(key, None)  # The cached factor belongs to the old covariance
+        if quantize_preserved_keys and torch.is_tensor(preserved_keys):
+            preserved_keys = quantize_rows(preserved_keys)
         COV_CACHE[feature_key] = preserved_keys
 
-    return COV_CACHE[key].to("cuda"), COV_CACHE[feature_key] 
+    # Pinned host memory lets the copy run asynchronously on a side stream;
+    # callers must wait on `get_cov_stream()` before using the covariance
+    with torch.cuda.stream(get_cov_stream()):
+        cov = COV_CACHE[key].to("cuda", non_blocking=True)
+    return cov, COV_CACHE[feature_key] 
+
+
+def cov_cache_key(model: AutoModelForCausalLM, layer_name: str) -> Tuple[str, str]:
+    """
+    Key under which `get_cov` caches the covariance of `layer_name`, shared by CHOL_CACHE.
+    """
+
+    return (model.config._name_or_path.replace("/", "_"), layer_name)
+
 
-def calculate_distances(original_weights, new_weights, edit_keys, edit_values, preserved_keys):
-    preserved_keys = preserved_keys.to("cuda")
-    if original_weights.shape[0] != preserved_keys.shape[1]:
+def get_cov_stream() -> torch.cuda.Stream:
+    global COV_STREAM
+
+    if COV_STREAM is None:
+        COV_STREAM = torch.cuda.Stream()
+    return COV_STREAM
+
+def calculate_distances(original_weights, adj_k, resid, edit_keys, edit_values, preserved_keys):
+    """
+    Computes the preservation and edit distances of the update `resid @ adj_k.T`
+    without materializing the edited weights. The update has rank at most
+    #requests, so it is applied in factored form to the (many) preserved keys.
+    """
+    if isinstance(preserved_keys, tuple):
+        # int8 keys with per-row scales; the scales commute with the right-multiplication
+        keys, scales = preserved_keys
+        keys = keys.to("cuda")
+        preserved_proj = (keys.float() @ adj_k.float()) * scales.to("cuda")
+    else:
+        keys = preserved_keys.to("cuda")
+        preserved_proj = keys.float() @ adj_k.float()
+    if original_weights.shape[0] != keys.shape[1]:
         original_weights = original_weights.T
-        new_weights = new_weights.T
 
-    W_old_k_old = preserved_keys.double() @ original_weights.double()
-    W_hat_k_old = preserved_keys.double() @ new_weights.double()
+    # (W_hat - W_old) = adj_k @ resid.T in [d_in, d_out] orientation
+    preserved_diff = preserved_proj @ resid.float().T
 
     W_old_k_edits = original_weights.T.double() @ edit_keys.double()
-    W_hat_k_edits = new_weights.T.double() @ edit_keys.double()
+    W_hat_k_edits = W_old_k_edits + resid.double() @ (adj_k.T.double() @ edit_keys.double())
     v_edits = edit_values.double()
 
-    preservation_distance = torch.mean(torch.norm(W_hat_k_old - W_old_k_old, dim = 1)).detach().cpu().item()
+    preservation_distance = torch.mean(torch.norm(preserved_diff, dim = 1)).detach().cpu().item()
     new_edit_distance = torch.mean(torch.norm( W_hat_k_edits - v_edits, dim = 0)).detach().cpu().item()
     old_edit_distance = torch.mean(torch.norm( W_old_k_edits - v_edits, dim = 0)).detach().cpu().item()
 
-    preserved_keys = preserved_keys.to("cpu")
-
     return preservation_distance, new_edit_distance, old_edit_distance
 
+def spd_solve(A: torch.Tensor, B: torch.Tensor, precision: str = "fp64") -> torch.Tensor:
+    """
+    Solves A X = B for symmetric positive-definite A via a Cholesky factorization.
+    Falls back to an LU solve if A turns out not to be numerically positive-definite.
+    With precision "fp32" the factorization and solve run in single precision;
+    "mixed" additionally applies one step of iterative refinement, with the
+    residual computed in the precision of A.
+    """
+
+    if precision not in ("fp64", "fp32", "mixed"):
+        raise ValueError(f"solve_precision={precision} not recognized")
+
+    if precision != "fp64":
+        L, info = torch.linalg.cholesky_ex(A.float())
+        if info.item() == 0:
+            X = torch.cholesky_solve(B.float(), L).to(B.dtype)
+            if precision == "mixed":
+                X += torch.cholesky_solve((B - A @ X).float(), L).to(B.dtype)
+            return X
+        print("Single precision factorization failed, solving in double precision")
+
+    L, info = torch.linalg.cholesky_ex(A)
+    if info.item() != 0:
+        print("Covariance system is not positive-definite, falling back to LU solve")
+        return torch.linalg.solve(A, B)
+    return torch.cholesky_solve(B, L)
+
+
+def cached_factor_solve(
+    key: Tuple[str, str],
+    cov: torch.Tensor,
+    layer_ks: torch.Tensor,
+    track_edits: bool,
+    cov_tag: Any = None,
+    precision: str = "fp64",
+) -> torch.Tensor:
+    """
+    Solves (cov + K K^T) X = K reusing a Cholesky factor of the covariance, cached
+    in CHOL_CACHE under the same `key` as the covariance in COV_CACHE. Keys folded
+    into `cov` since the factor was computed are kept alongside it and, together
+    with K, applied as a low-rank (Woodbury) correction. The [d, d] matrix is only
+    refactorized once that correction stops being cheaper than doing so, or when
+    `cov_tag` (whatever else `cov` was derived with, e.g. its scaling) changes.
+    """
+
+    d, k = layer_ks.shape
+    L, pending, tag = CHOL_CACHE.get(key, (None, None, None))
+    if L is None or tag != cov_tag or (pending.size(1) + k) * 6 > d:
+        L, info = torch.linalg.cholesky_ex(cov)
+        if info.item() != 0 or k * 6 > d:
+            CHOL_CACHE.pop(key, None)
+            return spd_solve(cov + layer_ks @ layer_ks.T, layer_ks, precision)
+        pending = layer_ks.new_zeros(d, 0)
+
+    # (L L^T + U U^T)^{-1} U = L^{-T} L^{-1} U (I + U^T L^{-T} L^{-1} U)^{-1}; K is the tail of U
+    U = torch.cat([pending.to(layer_ks.device), layer_ks], dim=1)
+    r = U.size(1)
+    cov_inv_U = torch.cholesky_solve(U, L)
+    eye = torch.eye(r, dtype=U.dtype, device=U.device)
+    adj_k = cov_inv_U @ spd_solve(eye + U.T @ cov_inv_U, eye[:, r - k:])
+
+    CHOL_CACHE[key] = (L, U if track_edits else pending, cov_tag)
+    return adj_k
+
+
+def layer_update(
+    adj_k: torch.Tensor, targets: torch.Tensor, n_layers_left: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Distributes the residual across the remaining layers and forms the update matrix.
+    """
+
+    resid = targets / n_layers_left
+    return resid, resid @ adj_k.T
+
+
+def maybe_compile(fn, enabled: bool):
+    """
+    Returns `fn` compiled with torch.compile for fixed shapes if `enabled` and
+    supported by the installed PyTorch, else `fn` itself. Compiled functions
+    are memoized, so each is only traced once per shape.
+    """
+
+    if not enabled or not hasattr(torch, "compile"):
+        return fn
+    if fn not in COMPILED_FNS:
+        COMPILED_FNS[fn] = torch.compile(fn, dynamic=False)
+    return COMPILED_FNS[fn]
+
+
+def masked_add_(
+    w: torch.Tensor, upd_matrix: torch.Tensor, threshold: torch.Tensor, epsilon: float
+) -> torch.Tensor:
+    """
+    Adds to `w` only the entries of `upd_matrix` whose relative change
+    |upd / (w + epsilon)| is at least `threshold`. The comparison is rearranged
+    to avoid the division, so the caller can free its `delta` tensor first.
+    Building the boolean mask briefly needs |upd_matrix| and a weight-sized
+    bound. When the dtypes differ (a float64 update on float32 weights), the
+    update is also copied into `w`'s dtype and that copy is zeroed and added.
+    When they already match, `upd_matrix` itself is zeroed in place.
+    """
+
+    drop = upd_matrix.abs() < (w + epsilon).abs_().mul_(threshold)
+    return w.add_(upd_matrix.to(w.dtype).masked_fill_(drop, 0))
+
+
+def low_rank_norm(key_mat: torch.Tensor, val_mat: torch.Tensor) -> torch.Tensor:
+    """
+    Frobenius norm of key_mat @ val_mat.T, computed from the [k, k] Gram matrices
+    of the factors instead of the full [d_in, d_out] product.
+    """
+
+    return ((key_mat.T @ key_mat) * (val_mat.T @ val_mat)).sum().clamp_min(0).sqrt()
+
+
+def low_rank_singular_values(key_mat: torch.Tensor, val_mat: torch.Tensor) -> torch.Tensor:
+    """
+    Nonzero singular values of key_mat @ val_mat.T in descending order. With thin
+    QR factors key_mat = Q_k R_k and val_mat = Q_v R_v, the product shares its
+    singular values with the [k, k] matrix R_k @ R_v.T.
+    """
+
+    r_key = torch.linalg.qr(key_mat).R
+    r_val = torch.linalg.qr(val_mat).R
+    return torch.linalg.svdvals(r_key @ r_val.T).detach()
+
+
+def top_singular_values(matrix: torch.Tensor, rank: int) -> torch.Tensor:
+    """
+    Returns the leading singular values of `matrix` in descending order.
+    If `rank` is falsy the exact full spectrum is computed; otherwise a
+    randomized low-rank SVD (oversampled for accuracy) gives the top `rank`.
+    """
+
+    if not rank:
+        matrix = matrix.contiguous()
+        if matrix.is_cuda:
+            try:
+                # The Jacobi driver is considerably faster than the default on GPU
+                return torch.linalg.svdvals(matrix, driver="gesvdj").detach()
+            except (TypeError, RuntimeError):
+                pass
+        return torch.linalg.svdvals(matrix).detach()
+
+    q = min(rank + 10, *matrix.shape)
+    _, s, _ = torch.svd_lowrank(matrix, q=q, niter=4)
+    return s[:rank].detach()
+
+
 def upd_matrix_match_shape(matrix: torch.Tensor, shape: torch.Size) -> torch.Tensor:
     """
     GPT-2 and GPT-J have transposed weight representations.
@@ -421,19 +740,45 @@ def get_context_templates(model, tok):
     global CONTEXT_TEMPLATES_CACHE
 
     if CONTEXT_TEMPLATES_CACHE is None:
+        prefixes = ["The", "Therefore", "Because", "I", "You"]
+        gen_params = [(10, 7)]  # Be careful about changing this.
+
+        # Generated templates are also persisted, so new processes skip generate_fast
+        cache_key = hashlib.md5(
+            json.dumps(
+                [model.config._name_or_path, tok.name_or_path, prefixes, gen_params]
+            ).encode()
+        ).hexdigest()
+        cache_fname = STATS_DIR / f"context_templates_{cache_key}.json"
+        if cache_fname.exists():
+            try:
+                with open(cache_fname, "r") as f:
+                    CONTEXT_TEMPLATES_CACHE = json.load(f)
+                print(f"Loaded context templates from {cache_fname}")
+                return CONTEXT_TEMPLATES_CACHE
+            except json.JSONDecodeError:
+                print(f"Ignoring corrupt context template cache {cache_fname}")
+
         CONTEXT_TEMPLATES_CACHE = [["{}"]] + [
             [
                 f.replace("{", " ").replace("}", " ") + ". {}"
                 for f in generate_fast(
                     model,
                     tok,
-                    ["The", "Therefore", "Because", "I", "You"],
+                    prefixes,
                     n_gen_per_prompt=n_gen // 5,
                     max_out_len=length,
                 )
             ]
-            for length, n_gen in [(10, 7)]  # Be careful about changing this.
+            for length, n_gen in gen_params
         ]
         print(f"Cached context templates {CONTEXT_TEMPLATES_CACHE}")
 
+        # Written to a temporary file first so concurrent readers never see a partial file
+        cache_fname.parent.mkdir(exist_ok=True, parents=True)
+        tmp_fname = cache_fname.with_name(f".{cache_fname.name}.{os.getpid()}.tmp")
+        with open(tmp_fname, "w") as f:
+            json.dump(CONTEXT_TEMPLATES_CACHE, f)
+        os.replace(tmp_fname, cache_fname)
+
     return CONTEXT_TEMPLATES_CACHE
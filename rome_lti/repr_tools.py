@@ -4,7 +4,7 @@ from string templates. Used in computing the left and right vectors for ROME.
 """
 
 from copy import deepcopy
-from typing import List
+from typing import List, Optional, Tuple
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -117,35 +117,43 @@ def get_reprs_at_idxs(
     tok: AutoTokenizer,
     contexts: List[str],
     idxs: List[List[int]],
-    layer: int,
-    module_template: str,
+    layer: int = None,
+    module_template: str = None,
     track: str = "in",
+    tracks: Optional[List[Tuple[str, str]]] = None,
 ) -> torch.Tensor:
     """
     Runs input through model and returns averaged representations of the tokens
     at each index in `idxs`.
+    If `tracks` is given, it lists (module name, "in" or "out") pairs that are all
+    retrieved from the same forward passes, and a list with one tensor per pair
+    is returned; `layer`, `module_template` and `track` are then ignored.
     """
 
     def _batch(n):
         for i in range(0, len(contexts), n):
             yield contexts[i: i + n], idxs[i: i + n]
 
-    assert track in {"in", "out", "both"}
-    both = track == "both"
+    multi = tracks is not None
+    if not multi:
+        assert track in {"in", "out", "both"}
+        module_name = module_template.format(layer)
+        tracks = [(module_name, key) for key in ("in", "out") if track in {key, "both"}]
+    assert all(key in {"in", "out"} for _, key in tracks)
     tin, tout = (
-        (track == "in" or both),
-        (track == "out" or both),
+        any(key == "in" for _, key in tracks),
+        any(key == "out" for _, key in tracks),
     )
-    module_name = module_template.format(layer)
-    to_return = {"in": [], "out": []}
+    module_names = list(dict.fromkeys(module_name for module_name, _ in tracks))
+    to_return = [[] for _ in tracks]
 
-    def _process(cur_repr, batch_idxs, key):
+    def _process(cur_repr, batch_idxs, t):
         nonlocal to_return
         cur_repr = cur_repr[0] if type(cur_repr) is tuple else cur_repr
         if cur_repr.shape[0] != len(batch_idxs):
             cur_repr = cur_repr.transpose(0, 1)
         for i, idx_list in enumerate(batch_idxs):
-            to_return[key].append(cur_repr[i][idx_list].mean(0))
+            to_return[t].append(cur_repr[i][idx_list].mean(0))
 
     for batch_contexts, batch_idxs in _batch(n=128):
         contexts_tok = tok(batch_contexts, padding=True, return_tensors="pt").to(
@@ -153,23 +161,22 @@ def get_reprs_at_idxs(
         )
 
         with torch.no_grad():
-            with nethook.Trace(
+            with nethook.TraceDict(
                 module=model,
-                layer=module_name,
+                layers=module_names,
                 retain_input=tin,
                 retain_output=tout,
             ) as tr:
                 model(**contexts_tok)
 
-        if tin:
-            _process(tr.input, batch_idxs, "in")
-        if tout:
-            _process(tr.output, batch_idxs, "out")
+        for t, (module_name, key) in enumerate(tracks):
+            _process(tr[module_name].input if key == "in" else tr[module_name].output, batch_idxs, t)
 
-    to_return = {k: torch.stack(v, 0)
-                 for k, v in to_return.items() if len(v) > 0}
+    to_return = [torch.stack(v, 0) for v in to_return]
 
-    if len(to_return) == 1:
-        return to_return["in"] if tin else to_return["out"]
+    if multi:
+        return to_return
+    elif len(to_return) == 1:
+        return to_return[0]
     else:
-        return to_return["in"], to_return["out"]
+        return to_return[0], to_return[1]
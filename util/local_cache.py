@@ -0,0 +1,151 @@
+"""
+Local-disk LRU mirror for files that live on a (possibly networked) shared
+filesystem. Enabled by pointing the LOCAL_CACHE_DIR environment variable at
+fast local storage; LOCAL_CACHE_MAX_GB bounds its size. When LOCAL_CACHE_DIR
+is unset, every helper here is a no-op passthrough to the remote path.
+"""
+
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+LOCAL_CACHE_DIR = os.environ.get("LOCAL_CACHE_DIR")
+LOCAL_CACHE_MAX_BYTES = int(float(os.environ.get("LOCAL_CACHE_MAX_GB", "20")) * 2**30)
+
+_lock = threading.Lock()
+_cache_bytes = None
+
+
+def local_path(remote: Path) -> Optional[Path]:
+    """
+    Returns the location of `remote` inside the local mirror, or None if
+    no local cache is configured. The full remote path is mirrored so that
+    files sharing a basename across directories do not collide.
+    """
+
+    if LOCAL_CACHE_DIR is None:
+        return None
+    return Path(LOCAL_CACHE_DIR) / str(Path(remote).resolve()).lstrip(os.sep)
+
+
+def resolve_local(remote: Path) -> Path:
+    """
+    Returns a path to read `remote` from. On a hit the local copy is returned
+    (and marked as recently used); on a miss the remote file is copied into
+    the mirror first. If the remote file does not exist, `remote` is returned
+    unchanged so callers can test for existence as usual.
+    """
+
+    local = local_path(remote)
+    if local is None:
+        return remote
+    try:
+        os.utime(local)
+        return local
+    except FileNotFoundError:
+        pass
+    if not remote.exists():
+        return remote
+
+    _copy_atomic(remote, local)
+    try:
+        os.utime(local)  # copy2 keeps the remote mtime, which would make it first in line for eviction
+    except FileNotFoundError:
+        # Evicted by another job sharing the mirror before we could use it
+        return remote
+    _account(local)
+    return local
+
+
+def write_through(local: Path, remote: Path):
+    """
+    Uploads a file that was written into the local mirror to its remote location.
+    """
+
+    remote.parent.mkdir(exist_ok=True, parents=True)
+    _copy_atomic(local, remote)
+    _account(local)
+
+
+def temp_path(dst: Path) -> Path:
+    """
+    Returns a temporary sibling of `dst`, unique per process and thread, to
+    write into before moving it into place with `os.replace`.
+    """
+
+    return dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _copy_atomic(src: Path, dst: Path):
+    dst.parent.mkdir(exist_ok=True, parents=True)
+    tmp = temp_path(dst)
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _account(path: Path):
+    """
+    Adds `path` to the tracked mirror size and evicts if over budget. The
+    mirror may be shared with other jobs, so this is best effort and never
+    raises: a failed eviction is retried on the next call.
+    """
+
+    global _cache_bytes
+
+    try:
+        n_bytes = path.stat().st_size
+    except FileNotFoundError:
+        n_bytes = 0
+
+    with _lock:
+        try:
+            if _cache_bytes is None:
+                _cache_bytes = sum(size for _, size, _ in _cached_files())
+            else:
+                _cache_bytes += n_bytes
+
+            if _cache_bytes > LOCAL_CACHE_MAX_BYTES:
+                _evict(int(0.9 * LOCAL_CACHE_MAX_BYTES))
+        except OSError as e:
+            print(f"Local cache eviction failed: {e}")
+
+
+def _evict(target_bytes: int):
+    """
+    Removes least recently used files until the mirror is below `target_bytes`.
+    Must be called with `_lock` held.
+    """
+
+    global _cache_bytes
+
+    files = sorted(_cached_files(), key=lambda entry: entry[2])
+    for f, size, _ in files:
+        if _cache_bytes <= target_bytes:
+            break
+        try:
+            f.unlink()
+        except FileNotFoundError:
+            pass  # Already removed by another job, so it no longer counts either
+        _cache_bytes -= size
+
+
+def _cached_files():
+    """
+    Returns (path, size, mtime) for every file in the mirror. Each file is
+    stat'ed once; files removed concurrently by another job are skipped.
+    """
+
+    entries = []
+    for root, _, names in os.walk(LOCAL_CACHE_DIR):
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            f = Path(root) / name
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((f, st.st_size, st.st_mtime))
+    return entries